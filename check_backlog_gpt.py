@@ -1,8 +1,32 @@
-import os, re, asyncio, json, base64
-from datetime import datetime
-import pytz
-import requests
-from playwright.async_api import async_playwright, TimeoutError as PWTimeout
+import os, re, asyncio, json, base64, hashlib, signal, time
+from datetime import datetime, timedelta
+from io import BytesIO
+from zoneinfo import ZoneInfo
+import httpx
+import lxml.html
+from PIL import Image
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup, stdlib works too
+    orjson = None
+try:
+    import pybase64 as _b64  # SIMD-accelerated; worthwhile on megabyte screenshots
+except ImportError:
+    _b64 = base64
+
+def _json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def _json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+def _json_dumps_pretty(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
 
 print("=== RadAlert LOGIN HANDLER v5 (visible-inputs) ===")
 
@@ -10,7 +34,7 @@ print("=== RadAlert LOGIN HANDLER v5 (visible-inputs) ===")
 # Config (from environment)
 # ----------------------------
 LOGIN_URL = "https://avrteleris.com/AVR/Index.aspx"
-TZ = pytz.timezone("America/New_York")
+TZ = ZoneInfo("America/New_York")
 
 AVR_USER = os.environ["AVR_USER"]
 AVR_PASS = os.environ["AVR_PASS"]
@@ -27,64 +51,355 @@ SITE_LABEL = os.environ.get("SITE_LABEL", "Baptist Health Corbin (AVR)")
 
 DRY_RUN = os.environ.get("DRY_RUN", "false").lower() == "true"
 
+# >0 keeps the process alive and re-checks every N minutes with a warm
+# browser; 0 preserves the original one-shot (cron-driven) behaviour.
+LOOP_INTERVAL_MINUTES = int(os.environ.get("LOOP_INTERVAL_MINUTES", "0"))
+
+# Where the authenticated Playwright storage state is cached between runs
+STATE_FILE = os.environ.get("AVR_STATE_FILE", "avr_state.json")
+
+# In loop mode, close the warm browser when the next tick is further away
+# than this — the cold-start saving isn't worth holding Chromium's RAM for
+# minutes of idling. It is relaunched on demand.
+BROWSER_IDLE_SECONDS = int(os.environ.get("BROWSER_IDLE_SECONDS", "60"))
+
+# The .aspx login page is usually plain server-rendered HTML, so client-side
+# JS (ViewState validators etc.) is skippable. Opt-in; a failed JS-less
+# attempt is retried with JS enabled before giving up.
+JSLESS_LOGIN = os.environ.get("JSLESS_LOGIN", "false").lower() == "true"
+
+# ----------------------------
+# HTTP client (keep-alive + HTTP/2)
+# ----------------------------
+# One shared async client: Telegram and OpenAI each keep a warm connection in
+# the pool, POSTs no longer block the event loop, and HTTP/2 multiplexes
+# concurrent requests to the same host (OpenAI serves h2).
+_HTTP = httpx.AsyncClient(
+    timeout=120,
+    # limits must ride on the transport: the client-level argument is
+    # ignored once an explicit transport is supplied.
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=8),
+    ),
+)
+
 # ----------------------------
 # Helpers
 # ----------------------------
-def within_window_now():
-    now = datetime.now(TZ)
-    wd, hr = now.weekday(), now.hour
-    if wd in range(0, 5) and hr in (18, 20, 22):
-        return True
-    if wd == 5 and hr in (4, 6, 8, 10, 12, 14, 16, 18, 20, 22):
-        return True
-    return False
+# Alerting schedule, constant-folded once at import: Mon-Fri evenings plus
+# every other hour on Saturday, as a flat (weekday, hour) membership set.
+_WINDOW_MASK = frozenset(
+    {(wd, h) for wd in range(5) for h in (18, 20, 22)}
+    | {(5, h) for h in range(4, 23, 2)}
+)
+
+def within_window_now(now=None):
+    if now is None:
+        now = datetime.now(TZ)
+    return (now.weekday(), now.hour) in _WINDOW_MASK
+
+_CT_MRI_RE = re.compile(r"\b(CT|MRI)\b", re.I)
+
+_STAMP_FORMATS = (
+    "%m/%d/%Y %H:%M",
+    "%m/%d/%Y %I:%M %p",
+    "%m/%d/%Y %I:%M:%S %p",
+    "%m/%d/%y %H:%M",
+    "%Y-%m-%d %H:%M",
+)
+
+def _parse_worklist_stamp(text):
+    text = text.strip()
+    for fmt in _STAMP_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).replace(tzinfo=TZ)
+        except ValueError:
+            continue
+    return None
+
+def count_from_worklist_json(data, now_et):
+    """Count CT/MRI procedures older than AGE_MINUTES straight from the
+    worklist JSON payload. Returns the same schema ask_gpt_vision produces,
+    or None when the payload doesn't look like a worklist we understand."""
+    rows = None
+    if isinstance(data, list):
+        rows = data
+    elif isinstance(data, dict):
+        for v in data.values():
+            if isinstance(v, list) and v and isinstance(v[0], dict):
+                rows = v
+                break
+    if not rows:
+        return None
+
+    cutoff = now_et - timedelta(minutes=AGE_MINUTES)
+    counts = {"CT": 0, "MRI": 0}
+    samples = []
+    parsed_any = False
+    for row in rows:
+        if not isinstance(row, dict):
+            return None
+        study = ""
+        stamp = None
+        for val in row.values():
+            if not isinstance(val, str):
+                continue
+            if stamp is None:
+                stamp = _parse_worklist_stamp(val)
+                if stamp is not None:
+                    continue
+            if _CT_MRI_RE.search(val):
+                study = f"{study}, {val}" if study else val
+        if stamp is None:
+            continue
+        parsed_any = True
+        if stamp > cutoff or not study:
+            continue
+        for modality in _CT_MRI_RE.findall(study):
+            counts[modality.upper()] += 1
+        if len(samples) < 5:
+            samples.append(study[:80])
+
+    if not parsed_any:
+        return None
+    return _make_result(counts, samples)
+
+def _make_result(counts, samples):
+    # Same schema ask_gpt_vision returns, so callers don't care which path ran
+    return {
+        "count_ct_mri_over_60": counts["CT"] + counts["MRI"],
+        "by_modality": counts,
+        "sample_ids_or_rows": samples,
+    }
+
+def count_ct_mri_from_html(table_html, now_et):
+    """Deterministic counterpart of ask_gpt_vision: parse the worklist table
+    and count CT/MRI procedures older than AGE_MINUTES. Returns None when the
+    layout isn't recognized, so the vision call can take over."""
+    try:
+        doc = lxml.html.fromstring(table_html)
+        rows = doc.xpath("//tr")
+    except Exception:
+        return None
+    if not rows:
+        return None
+
+    header = [c.text_content().strip().lower() for c in rows[0].xpath("./th|./td")]
+    date_idx = time_idx = study_idx = None
+    for i, name in enumerate(header):
+        if date_idx is None and "date" in name:
+            date_idx = i
+        elif time_idx is None and "time" in name:
+            time_idx = i
+        elif study_idx is None and ("study" in name or "procedure" in name or "exam" in name):
+            study_idx = i
+    if study_idx is None:
+        # Some layouts label the column "Modality" instead of "Study Requested"
+        for i, name in enumerate(header):
+            if "modality" in name:
+                study_idx = i
+                break
+    if date_idx is None or study_idx is None:
+        return None
+
+    cutoff = now_et - timedelta(minutes=AGE_MINUTES)
+    counts = {"CT": 0, "MRI": 0}
+    samples = []
+    parsed_any = False
+    for row in rows[1:]:
+        cells = [c.text_content().strip() for c in row.xpath("./td")]
+        if len(cells) <= max(date_idx, study_idx):
+            continue
+        stamp_text = cells[date_idx]
+        if time_idx is not None and time_idx < len(cells):
+            stamp_text = f"{stamp_text} {cells[time_idx]}".strip()
+        stamp = _parse_worklist_stamp(stamp_text)
+        if stamp is None:
+            continue
+        parsed_any = True
+        if stamp > cutoff:
+            continue
+        study = cells[study_idx]
+        hits = _CT_MRI_RE.findall(study)
+        for modality in hits:
+            counts[modality.upper()] += 1
+        if hits and len(samples) < 5:
+            samples.append(study[:80])
+
+    if not parsed_any:
+        return None
+    return _make_result(counts, samples)
+
+def compact_table_text(table_html, max_rows=500):
+    """Flatten the worklist table to tab-separated text for the model: the
+    header row plus rows that mention CT/MRI, cell text only. Attributes,
+    inline styles and markup are the bulk of the raw .aspx HTML and carry no
+    signal, so dropping them cuts the payload several-fold."""
+    try:
+        doc = lxml.html.fromstring(table_html)
+        rows = doc.xpath("//tr")
+    except Exception:
+        rows = []
+    if not rows:
+        return table_html[:120000]
+    lines = []
+    for i, row in enumerate(rows):
+        cells = [c.text_content().strip() for c in row.xpath("./td|./th")]
+        if not cells:
+            continue
+        line = "\t".join(cells)
+        if i == 0 or _CT_MRI_RE.search(line):
+            lines.append(line)
+        if len(lines) > max_rows:
+            break
+    return "\n".join(lines)
+
+# Single-entry memo: the same screenshot can be encoded on both the DRY_RUN
+# and model paths within one run, and b64 of a large PNG isn't free.
+_DATA_URL_CACHE = {}
+
+def _image_mime(image_bytes: bytes) -> str:
+    return "image/jpeg" if image_bytes[:3] == b"\xff\xd8\xff" else "image/png"
+
+def to_data_url(image_bytes: bytes) -> str:
+    key = hashlib.sha256(image_bytes).digest()
+    cached = _DATA_URL_CACHE.get(key)
+    if cached is None:
+        # Grow one bytearray instead of decode-then-concat, which copies the
+        # whole base64 payload an extra time on large screenshots.
+        buf = bytearray(b"data:")
+        buf += _image_mime(image_bytes).encode("ascii")
+        buf += b";base64,"
+        buf += _b64.b64encode(image_bytes)
+        cached = bytes(buf).decode("ascii")
+        _DATA_URL_CACHE.clear()
+        _DATA_URL_CACHE[key] = cached
+    return cached
+
+# Whether the model call may include a screenshot at all. The happy path is
+# already text-only (table rows); USE_VISION=false keeps even shaky
+# extractions text-only and skips the fallback screenshot capture entirely.
+USE_VISION = os.environ.get("USE_VISION", "true").lower() == "true"
+
+def shrink_png(png_bytes: bytes, max_edge: int = 1024, quality: int = 80) -> bytes:
+    """Downscale the screenshot and re-encode as JPEG. Worklist pages are
+    text on white, where JPEG q=80 is several times smaller than PNG, and
+    ~1024px on the long edge is plenty for the low-detail vision path."""
+    try:
+        img = Image.open(BytesIO(png_bytes))
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        buf = BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=quality, optimize=True)
+        return buf.getvalue()
+    except Exception:
+        return png_bytes
 
-def to_data_url(png_bytes: bytes) -> str:
-    return "data:image/png;base64," + base64.b64encode(png_bytes).decode()
+TG_CHUNK = 3500
 
-def send_telegram_text(text: str):
+def _chunk_text(text: str, size: int = TG_CHUNK):
+    return [text[i:i+size] for i in range(0, len(text), size)]
+
+async def _post_telegram_chunk(chunk: str):
     url = f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendMessage"
-    CHUNK = 3500
-    if len(text) <= CHUNK:
-        requests.post(url, json={"chat_id": TG_CHAT_ID, "text": text, "parse_mode": "HTML"}, timeout=30)
-    else:
-        i = 0
-        while i < len(text):
-            chunk = text[i:i+CHUNK]
-            requests.post(url, json={"chat_id": TG_CHAT_ID, "text": chunk, "parse_mode": "HTML"}, timeout=30)
-            i += CHUNK
+    await _HTTP.post(url, json={"chat_id": TG_CHAT_ID, "text": chunk, "parse_mode": "HTML"}, timeout=30)
+
+# Telegram allows roughly 1 message/s per chat; serialize multi-chunk sends
+# so chunks arrive in order and under the limit, while the warm HTTP/2
+# connection still avoids a handshake per chunk.
+_TG_LOCK = asyncio.Lock()
+_TG_CHUNK_DELAY = 1.05
+
+async def send_telegram_text_async(text: str):
+    chunks = _chunk_text(text)
+    if len(chunks) == 1:
+        await _post_telegram_chunk(chunks[0])
+        return
+    async with _TG_LOCK:
+        for i, chunk in enumerate(chunks):
+            if i:
+                await asyncio.sleep(_TG_CHUNK_DELAY)
+            await _post_telegram_chunk(chunk)
 
-def send_telegram_photo(png_bytes: bytes, caption: str = ""):
+async def send_telegram_photo(png_bytes: bytes, caption: str = ""):
     try:
-        files = {"photo": ("image.png", png_bytes)}
-        requests.post(
+        ext = "jpg" if _image_mime(png_bytes) == "image/jpeg" else "png"
+        files = {"photo": (f"image.{ext}", png_bytes)}
+        await _HTTP.post(
             f"https://api.telegram.org/bot{TG_BOT_TOKEN}/sendPhoto",
             data={"chat_id": TG_CHAT_ID, "caption": caption},
             files=files, timeout=30
         )
     except Exception as e:
-        send_telegram_text(f"Could not send screenshot: {e}")
-
-def ask_gpt_vision(image_data_url: str, table_html: str, now_iso_et: str) -> dict:
-    system = (
-        "You are a meticulous auditor. You extract counts from a radiology worklist screenshot and corresponding HTML. "
-        "Output STRICT JSON only, no prose."
-    )
-    user_prompt = f"""
-You are given a screenshot and the corresponding HTML of the 'Worklist' table from a radiology prelim system.
+        await send_telegram_text_async(f"Could not send screenshot: {e}")
 
-Goal: Count all CT and MRI procedures that are > {AGE_MINUTES} minutes old at the current time (ET).
+async def _drain_pending(pending, timeout=5.0):
+    """Give the background sends a bounded window to finish. Delivery is not
+    worth extending the run's wall time indefinitely: anything still in
+    flight after the grace period is abandoned."""
+    if not pending:
+        return
+    done, still_running = await asyncio.wait(pending, timeout=timeout)
+    if still_running:
+        print(f"abandoning {len(still_running)} unfinished Telegram send(s) after {timeout}s")
+        for task in still_running:
+            task.cancel()
+
+# When the worklist hasn't changed between window checks, the model answer
+# won't change either — cache it on disk keyed by content.
+CACHE_DIR = os.environ.get("RADALERT_CACHE_DIR", ".cache")
+
+def _gpt_cache_key(table_html, png_bytes):
+    h = hashlib.sha256()
+    # Normalize whitespace so cosmetic DOM churn doesn't bust the cache
+    h.update(" ".join(table_html.split()).encode())
+    h.update(png_bytes or b"")
+    return h.hexdigest()
+
+def _gpt_cache_get(key):
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(path) < AGE_MINUTES * 60:
+            with open(path, "rb") as f:
+                return _json_loads(f.read())
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _gpt_cache_put(key, result):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = os.path.join(CACHE_DIR, f".{key}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp, os.path.join(CACHE_DIR, f"{key}.json"))
+    except OSError:
+        pass
+
+# Prompt scaffolding is constant per process — built once here rather than on
+# every call (which matters in loop mode). The static instruction text is
+# also kept byte-identical across calls, in its own leading message, so the
+# provider's prefix-hash prompt cache can hit on it; everything dynamic
+# (NOW_ET, table, image) rides in a separate trailing message.
+_SYSTEM_PROMPT = (
+    "You are a meticulous auditor. You extract counts from a radiology worklist screenshot and corresponding HTML. "
+    "Output STRICT JSON only, no prose."
+)
+_USER_PROMPT_TEMPLATE = """
+You are given the extracted rows (tab-separated) of the 'Worklist' table from a radiology prelim system, and sometimes a screenshot.
+
+Goal: Count all CT and MRI procedures that are > {age} minutes old at the current time (ET).
 
 Counting rules (IMPORTANT):
 - Count PROCEDURES, not rows.
 - If a single row's 'Study Requested' contains multiple CT/MRI items (e.g., 'CT ABD PELVIS W/ IV, CT CHEST W/O' or 'MRI BRAIN, MRI C-SPINE'),
   count EACH CT/MRI occurrence separately.
-- A procedure qualifies if the row's Date + Time (request time) is more than {AGE_MINUTES} minutes before NOW_ET.
+- A procedure qualifies if the row's Date + Time (request time) is more than {age} minutes before NOW_ET.
 - Ignore all non-CT, non-MRI studies (e.g., XRAY, US, etc.).
 - If anything is ambiguous, be conservative.
 - Assume timestamps are ET unless otherwise labeled.
-
-NOW_ET (ISO8601): {now_iso_et}
+- NOW_ET is provided in a follow-up message.
 
 Return JSON ONLY with this schema:
 {{
@@ -93,33 +408,148 @@ Return JSON ONLY with this schema:
   "sample_ids_or_rows": [<up to 5 short identifiers or row snippets you used>]
 }}
 """
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+_USER_INSTRUCTIONS = _USER_PROMPT_TEMPLATE.format(age=AGE_MINUTES)
+_OAI_HEADERS = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+_OAI_RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+def _extract_json_object(text):
+    """Last-resort salvage for non-JSON model output: return the first
+    balanced {...} span. A linear scan, unlike the old greedy regex that
+    could backtrack badly on malformed multi-object strings."""
+    start = text.find("{")
+    while start != -1:
+        depth = 0
+        in_string = False
+        escaped = False
+        for i in range(start, len(text)):
+            ch = text[i]
+            # Braces inside string literals (row snippets can contain
+            # anything) must not move the depth counter.
+            if escaped:
+                escaped = False
+            elif in_string:
+                if ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    return text[start:i + 1]
+        start = text.find("{", start + 1)
+    return None
+
+async def ask_gpt_vision(image_data_url: str, table_html: str, now_iso_et: str) -> dict:
+    content = [
+        {"type": "text", "text": f"NOW_ET (ISO8601): {now_iso_et}"},
+        {"type": "text", "text": f"TABLE_ROWS (tab-separated):\n{compact_table_text(table_html)}"},
+    ]
+    # The screenshot is only attached when the HTML extraction was shaky;
+    # on the happy path the table HTML alone is the source of truth and the
+    # call stays a cheap text-only completion.
+    if image_data_url:
+        content.append({"type": "image_url", "image_url": {"url": image_data_url, "detail": "low"}})
     payload = {
         "model": MODEL,
         "messages": [
-            {"role": "system", "content": system},
-            {"role": "user", "content": [
-                {"type": "text", "text": user_prompt},
-                {"type": "text", "text": f"TABLE_HTML:\n{table_html[:120000]}"},
-                {"type": "image_url", "image_url": {"url": image_data_url}}
-            ]}
+            {"role": "system", "content": _SYSTEM_PROMPT},
+            {"role": "user", "content": _USER_INSTRUCTIONS},
+            {"role": "user", "content": content}
         ],
-        "temperature": 0
+        "temperature": 0,
+        # JSON mode: the model can't wrap the object in prose or ``` fences,
+        # so the regex salvage below stays as a never-hit safety net.
+        "response_format": {"type": "json_object"}
     }
-    resp = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload, timeout=120)
-    resp.raise_for_status()
-    content = resp.json()["choices"][0]["message"]["content"].strip()
+    payload["stream"] = True
+    # Stream the completion and stop as soon as the JSON object closes: for a
+    # ~100-token object the time-to-first-token vs time-to-last-token gap is
+    # pure waiting, and with JSON mode the braces balancing means we're done —
+    # no need to sit through the trailing [DONE] frame.
+    # Encode the body ourselves: the payload carries the base64 image, and
+    # orjson.dumps is several times faster than httpx's stdlib json= path on
+    # a ~200KB document.
+    body = _json_dumps(payload)
+    for attempt in range(3):
+        parts = []
+        depth = 0
+        opened = False
+        in_string = False
+        escaped = False
+        try:
+            async with _HTTP.stream("POST", "https://api.openai.com/v1/chat/completions",
+                                    headers=_OAI_HEADERS, content=body, timeout=120) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    data = line[6:]
+                    if data == "[DONE]":
+                        break
+                    chunk = _json_loads(data)
+                    if not chunk.get("choices"):
+                        continue
+                    delta = chunk["choices"][0].get("delta", {}).get("content")
+                    if not delta:
+                        continue
+                    parts.append(delta)
+                    # Same string-aware scan as _extract_json_object: a } in
+                    # a quoted row snippet must not end the stream early.
+                    for ch in delta:
+                        if escaped:
+                            escaped = False
+                        elif in_string:
+                            if ch == "\\":
+                                escaped = True
+                            elif ch == '"':
+                                in_string = False
+                        elif ch == '"':
+                            in_string = True
+                        elif ch == "{":
+                            depth += 1
+                            opened = True
+                        elif ch == "}":
+                            depth -= 1
+                    if opened and depth <= 0:
+                        break
+            break
+        except httpx.HTTPStatusError as e:
+            # The transport only retries connect failures; rate limits and
+            # transient 5xx need a backoff of their own.
+            if attempt == 2 or e.response.status_code not in _OAI_RETRY_STATUS:
+                raise
+            await asyncio.sleep(2 ** attempt)
+    content = "".join(parts).strip()
     try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        m = re.search(r"\{.*\}", content, re.S)
-        if not m:
+        return _json_loads(content)
+    except ValueError:
+        obj = _extract_json_object(content)
+        if obj is None:
             raise
-        return json.loads(m.group(0))
+        return _json_loads(obj)
 
 # ----------------------------
 # Login helpers
 # ----------------------------
+# Stylesheets stay enabled so the final screenshot still renders legibly
+# for the vision model; everything else is dead weight for a table scrape.
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media", "texttrack", "beacon", "csp_report", "imageset"}
+_ANALYTICS_HOST_RE = re.compile(r"googletagmanager|google-analytics|doubleclick|segment\.io|hotjar", re.I)
+
+async def block_heavy_resources(ctx):
+    # Registered on the context so iframes and any popups are covered too
+    async def _route(route):
+        req = route.request
+        if req.resource_type in BLOCKED_RESOURCE_TYPES or _ANALYTICS_HOST_RE.search(req.url):
+            await route.abort()
+        else:
+            await route.continue_()
+    await ctx.route("**/*", _route)
+
 async def click_prelogin_tiles(page):
     # Try the obvious tiles/links to reveal the login form
     selectors = [
@@ -127,18 +557,40 @@ async def click_prelogin_tiles(page):
         'text=/Preliminary Reports/i',
         'a:has-text("RESULTS REPORTING SYSTEM")',
         'a:has-text("Preliminary Reports")',
-        'xpath=(//a)[1]'
     ]
-    for sel in selectors:
+    # Race the targeted candidates instead of probing serially: worst case
+    # drops from one 1.5s timeout per selector to a single timeout overall.
+    # The first-anchor catch-all stays out of the race — cancelling a task
+    # doesn't undo an in-flight click, and a stray click on the page's first
+    # link could navigate away from the just-revealed form.
+    tasks = [
+        asyncio.create_task(page.locator(sel).first.click(timeout=1500))
+        for sel in selectors
+    ]
+    outstanding = set(tasks)
+    clicked = False
+    while outstanding and not clicked:
+        done, outstanding = await asyncio.wait(outstanding, return_when=asyncio.FIRST_COMPLETED)
+        clicked = any(t.exception() is None for t in done)
+    for t in outstanding:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    if not clicked:
+        # Serial last resort, as in the original ordering
         try:
-            await page.click(sel, timeout=1500)
-            await page.wait_for_timeout(500)
-            # If we now see a password box, we’re good
-            if await page.locator('input[type="password"]:visible').first.count() > 0:
-                return True
+            await page.locator('xpath=(//a)[1]').first.click(timeout=1500)
         except Exception:
-            continue
-    return False
+            return False
+    # If the password box shows up, we’re good — wait on it directly
+    # instead of a fixed pause.
+    try:
+        await page.locator('input[type="password"]:visible').first.wait_for(
+            state="visible", timeout=2000
+        )
+        return True
+    except Exception:
+        return False
 
 async def fill_visible_inputs(target, user, pw) -> bool:
     """Fill first VISIBLE text input and first VISIBLE password input on this target."""
@@ -147,28 +599,29 @@ async def fill_visible_inputs(target, user, pw) -> bool:
         user_box = target.locator('input[type="text"]:visible').first
         pass_box = target.locator('input[type="password"]:visible').first
 
-        # Ensure they exist and are visible
-        await user_box.wait_for(state="visible", timeout=1500)
-        await pass_box.wait_for(state="visible", timeout=1500)
-
-        await user_box.fill(user, timeout=1500)
-        await pass_box.fill(pw, timeout=1500)
+        # Ensure they exist and are visible, then fill — both boxes are
+        # independent, so each pair of round-trips runs concurrently
+        await asyncio.gather(
+            user_box.wait_for(state="visible", timeout=1500),
+            pass_box.wait_for(state="visible", timeout=1500),
+        )
+        await asyncio.gather(
+            user_box.fill(user, timeout=1500),
+            pass_box.fill(pw, timeout=1500),
+        )
 
-        # Click an Enter/submit control if present; else press Enter
-        clicked = False
-        for sel in [
-            'button:has-text("Enter")',
-            'input[type="submit"]:visible',
-            'input[value*="Enter" i]:visible',
+        # Click an Enter/submit control if present; else press Enter.
+        # One comma-joined locator resolves the first match in a single
+        # round-trip instead of burning a timeout per candidate selector.
+        submit_sel = (
+            'button:has-text("Enter"), '
+            'input[type="submit"]:visible, '
+            'input[value*="Enter" i]:visible, '
             'button[type="submit"]:visible'
-        ]:
-            try:
-                await target.click(sel, timeout=800)
-                clicked = True
-                break
-            except Exception:
-                continue
-        if not clicked:
+        )
+        try:
+            await target.locator(submit_sel).first.click(timeout=2000)
+        except Exception:
             try:
                 await pass_box.press("Enter")
             except Exception:
@@ -177,6 +630,15 @@ async def fill_visible_inputs(target, user, pw) -> bool:
     except Exception:
         return False
 
+async def already_logged_in(page) -> bool:
+    # With a reused session cookie the server skips the login form and the
+    # Worklist shows up almost immediately.
+    try:
+        await page.locator("text=Worklist").first.wait_for(state="visible", timeout=2000)
+        return True
+    except Exception:
+        return False
+
 async def perform_login(page, user, pw) -> bool:
     await click_prelogin_tiles(page)
 
@@ -195,61 +657,169 @@ async def perform_login(page, user, pw) -> bool:
     return False
 
 # ----------------------------
-# Main one-shot run
+# Main run
 # ----------------------------
-async def run_once():
-    if not DRY_RUN and not within_window_now():
-        return
+# All three table-finding strategies (Worklist heading -> nearby table,
+# first table on the page, whole-document fallback) run in-browser in one
+# evaluate() call; the rect comes back alongside so the screenshot clip
+# needs no extra bounding_box() round-trip.
+_TABLE_EXTRACT_JS = """
+() => {
+  const heads = [...document.querySelectorAll('*')]
+    .filter(e => /Worklist/i.test(e.textContent || '') && e.children.length < 5);
+  let t = null;
+  for (const h of heads) {
+    t = h.parentElement && h.parentElement.querySelector('table');
+    if (t) break;
+  }
+  if (!t) t = document.querySelector('table');
+  if (t) {
+    const r = t.getBoundingClientRect();
+    return {html: t.outerHTML, ok: true,
+            rect: {x: r.x + window.scrollX, y: r.y + window.scrollY,
+                   width: r.width, height: r.height}};
+  }
+  // Cap the whole-document fallback in-browser so a multi-MB DOM never
+  // crosses the CDP wire just to be truncated Python-side anyway.
+  return {html: document.documentElement.outerHTML.slice(0, 150000), ok: false, rect: null};
+}
+"""
 
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        ctx = await browser.new_context()
+class LoginNotFound(RuntimeError):
+    pass
+
+async def _check_backlog(browser, js_enabled=True):
+    """One backlog check against an already-launched browser."""
+    from playwright.async_api import Error as PWError, TimeoutError as PWTimeout
+
+    # Fire-and-forget sends that must complete before we return
+    pending = []
+    state_loaded = os.path.exists(STATE_FILE)
+    ctx = await browser.new_context(
+        storage_state=STATE_FILE if state_loaded else None,
+        java_script_enabled=js_enabled,
+    )
+    try:
+        await block_heavy_resources(ctx)
         page = await ctx.new_page()
 
-        await page.goto(LOGIN_URL, wait_until="domcontentloaded")
+        # If the app fetches the worklist over XHR, the JSON is a far better
+        # source than scraped DOM — remember any such responses.
+        captured = []
+        def _capture_worklist(resp):
+            try:
+                if "worklist" in resp.url.lower() and resp.request.resource_type in ("xhr", "fetch"):
+                    captured.append(resp)
+            except Exception:
+                pass
+        page.on("response", _capture_worklist)
+
+        # "commit" returns as soon as the main document starts arriving; the
+        # element waits below cover everything we actually read.
+        await page.goto(LOGIN_URL, wait_until="commit")
 
-        logged_in = await perform_login(page, AVR_USER, AVR_PASS)
+        # A warm storage state usually lands us straight on the dashboard;
+        # only run the selector-heavy login dance when the session is stale.
+        # Without a state file the probe can't succeed, so don't pay its
+        # 2s timeout on cold runs.
+        logged_in = state_loaded and await already_logged_in(page)
+        if not logged_in:
+            logged_in = await perform_login(page, AVR_USER, AVR_PASS)
 
         if not logged_in:
-            png_login = await page.screenshot(full_page=True)
+            png_login = shrink_png(await page.screenshot(full_page=True))
             if DRY_RUN:
-                send_telegram_photo(png_login, "RadAlert: could not find login fields. Screenshot.")
-            raise RuntimeError("Login fields not found. Check Telegram screenshot (DRY_RUN).")
+                await send_telegram_photo(png_login, "RadAlert: could not find login fields. Screenshot.")
+            raise LoginNotFound("Login fields not found. Check Telegram screenshot (DRY_RUN).")
 
-        # Post-login settle
+        # Post-login settle: wait for the Worklist itself instead of network
+        # quiescence, which dashboards like AVR never reach while polling.
         try:
-            await page.wait_for_load_state("networkidle", timeout=10000)
+            await page.locator("text=Worklist").first.wait_for(state="visible", timeout=15000)
+            await page.locator("xpath=(//table)[1]//tr").first.wait_for(timeout=5000)
         except PWTimeout:
             pass
 
-        # Grab table HTML if possible
-        table_html = ""
+        # Refresh the cached session so the next run can skip login entirely
         try:
-            worklist_heading = page.locator("text=Worklist").first
-            worklist_container = worklist_heading.locator("xpath=..")
-            table = worklist_container.locator("xpath=.//table").first
-            table_html = await table.evaluate("(el) => el.outerHTML")
+            await ctx.storage_state(path=STATE_FILE)
         except Exception:
+            pass
+
+        now_et = datetime.now(TZ)
+
+        # Prefer counting straight from an intercepted worklist JSON response;
+        # the scrape + vision path only runs when no usable XHR was seen.
+        result = None
+        for resp in reversed(captured):
             try:
-                table_html = await page.locator("xpath=(//table)[1]").evaluate("(el)=>el.outerHTML")
+                data = await resp.json()
             except Exception:
-                table_html = await page.content()
-
-        png_bytes = await page.screenshot(full_page=True)
-        if DRY_RUN:
-            send_telegram_photo(png_bytes, "RadAlert DRY_RUN: page screenshot after login.")
+                continue
+            result = count_from_worklist_json(data, now_et)
+            if result is not None:
+                break
 
+        table_html = ""
+        png_bytes = None
+        if result is None:
+            # One evaluate() finds the table, grabs its HTML and its page-space
+            # rect in a single CDP round-trip, instead of the old chain of
+            # locator lookups with a full page.content() fallback.
+            try:
+                extracted = await page.evaluate(_TABLE_EXTRACT_JS)
+            except PWError:
+                # Driver-side failures only (navigation raced, page gone);
+                # anything else is a real bug and should surface.
+                extracted = {"html": "", "ok": False, "rect": None}
+            table_html = extracted["html"]
+            table_ok = extracted["ok"]
+
+            # With clean table HTML in hand the screenshot adds nothing for the
+            # model — only capture one when extraction was shaky (or for the
+            # DRY_RUN Telegram photo). Clip to the table where possible.
+            if (not table_ok and USE_VISION) or DRY_RUN:
+                clip = extracted["rect"]
+                if clip and clip["width"] > 0 and clip["height"] > 0:
+                    png_bytes = await page.screenshot(clip=clip)
+                else:
+                    png_bytes = await page.screenshot(full_page=True)
+                png_bytes = shrink_png(png_bytes)
+        elif DRY_RUN:
+            png_bytes = shrink_png(await page.screenshot(full_page=True))
+
+        if DRY_RUN and png_bytes is not None:
+            pending.append(asyncio.create_task(
+                send_telegram_photo(png_bytes, "RadAlert DRY_RUN: page screenshot after login.")
+            ))
+    except BaseException:
         await ctx.close()
-        await browser.close()
-
-    now_et_iso = datetime.now(TZ).isoformat()
-    data_url = to_data_url(png_bytes)
-
-    result = ask_gpt_vision(data_url, table_html, now_et_iso)
+        raise
+    else:
+        # On the happy path teardown doesn't gate the model call: it runs as
+        # a background task and is gathered with the pending sends below.
+        pending.append(asyncio.create_task(ctx.close()))
+
+    now_et_iso = now_et.isoformat()
+    if result is None and table_html:
+        result = count_ct_mri_from_html(table_html, now_et)
+    if result is None:
+        png_for_model = png_bytes if USE_VISION else None
+        cache_key = _gpt_cache_key(table_html, png_for_model)
+        result = _gpt_cache_get(cache_key)
+        if result is None:
+            data_url = to_data_url(png_for_model) if png_for_model else None
+            result = await ask_gpt_vision(data_url, table_html, now_et_iso)
+            _gpt_cache_put(cache_key, result)
 
     if DRY_RUN:
-        pretty = json.dumps(result, indent=2)
-        send_telegram_text(f"🔍 <b>Dry-run JSON dump</b>\n<pre>{pretty}</pre>")
+        pretty = _json_dumps_pretty(result)
+        pending.append(asyncio.create_task(
+            send_telegram_text_async(f"🔍 <b>Dry-run JSON dump</b>\n<pre>{pretty}</pre>")
+        ))
+        # Dry-run output is the whole point of the run, and chunked dumps are
+        # paced ~1s apart — give them a longer grace than a live alert.
+        await _drain_pending(pending, timeout=30.0)
         return
 
     ct_mri = int(result.get("count_ct_mri_over_60", 0))
@@ -257,14 +827,96 @@ async def run_once():
     ct = by_mod.get("CT", 0); mri = by_mod.get("MRI", 0)
 
     if ct_mri > THRESHOLD:
-        stamp = datetime.now(TZ).strftime("%-I:%M %p %Z")
+        # Hand-rolled 12-hour stamp: strftime's %-I is glibc-only and a crash
+        # here is a silently missed alert. Reuses the run's single now_et.
+        now = now_et
+        hr12 = ((now.hour - 1) % 12) + 1
+        stamp = f"{hr12}:{now.minute:02d} {'PM' if now.hour >= 12 else 'AM'} {now.tzname()}"
         msg = (f"🟡 <b>Backlog alert</b> — {SITE_LABEL}\n"
                f"CT/MRI > {AGE_MINUTES} min old: <b>{ct_mri}</b> (CT: {ct}, MRI: {mri}) at {stamp}\n"
                f"{LOGIN_URL}")
-        send_telegram_text(msg)
+        pending.append(asyncio.create_task(send_telegram_text_async(msg)))
+    await _drain_pending(pending)
+
+async def _run_check(browser):
+    """One check, optionally attempting the login without JavaScript first."""
+    if not JSLESS_LOGIN:
+        await _check_backlog(browser)
+        return
+    try:
+        await _check_backlog(browser, js_enabled=False)
+    except LoginNotFound:
+        # This page apparently does need JS to reveal the form — redo with it on
+        await _check_backlog(browser, js_enabled=True)
+
+async def run_once():
+    if not DRY_RUN and not within_window_now(datetime.now(TZ)):
+        return
+
+    # Playwright's import alone costs ~200ms; on a cron cadence most ticks
+    # are outside the window, so pay it only after the check above passes.
+    from playwright.async_api import async_playwright
+
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        try:
+            await _run_check(browser)
+        finally:
+            await browser.close()
+
+async def run_loop():
+    """Long-lived mode: launch Chromium once and keep re-checking, so each
+    tick skips the multi-second browser cold start. If the browser dies we
+    relaunch it with exponential backoff; SIGTERM/SIGINT end the loop
+    cleanly so the browser isn't orphaned."""
+    from playwright.async_api import async_playwright
+
+    interval = LOOP_INTERVAL_MINUTES * 60
+    backoff = 5
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        try:
+            while not stop.is_set():
+                try:
+                    if DRY_RUN or within_window_now(datetime.now(TZ)):
+                        if not browser.is_connected():
+                            browser = await p.chromium.launch(headless=True)
+                        await _run_check(browser)
+                    backoff = 5
+                except Exception as e:
+                    print(f"run failed: {e!r}")
+                    if not browser.is_connected():
+                        await asyncio.sleep(backoff)
+                        backoff = min(backoff * 2, 300)
+                        browser = await p.chromium.launch(headless=True)
+                if interval > BROWSER_IDLE_SECONDS and browser.is_connected():
+                    await browser.close()
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if browser.is_connected():
+                await browser.close()
+
+async def _main():
+    try:
+        if LOOP_INTERVAL_MINUTES > 0:
+            await run_loop()
+        else:
+            await run_once()
+    finally:
+        await _HTTP.aclose()
 
 # ----------------------------
 # Entrypoint
 # ----------------------------
 if __name__ == "__main__":
-    asyncio.run(run_once())
+    asyncio.run(_main())